@@ -40,6 +40,10 @@ def register():
 
     bpy.types.TEXT_HT_footer.append(core.draw_syntax_footer)
 
+    # Indices of removed texts and previous files aren't kept.
+    bpy.app.handlers.load_post.append(core.purge_indices)
+    overrides.default.TEXT_OT_unlink.add_pre(core.unlink_pre, is_global=True)
+
 
 @utils.unsuppress
 def unregister():
@@ -51,5 +55,9 @@ def unregister():
     utils.unregister_classes(operators.classes)
 
     bpy.types.TEXT_HT_footer.remove(core.draw_syntax_footer)
+
+    bpy.app.handlers.load_post.remove(core.purge_indices)
+    overrides.default.TEXT_OT_unlink.remove_pre(core.unlink_pre)
+    core.purge_indices()
     # ui.remove_hit_test(functions.test_line_numbers)
     # functions.set_text_context_menu(False)
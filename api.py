@@ -422,6 +422,17 @@ class TextAPI(APIBase):
             fmt[-1] = fmt[-1][:selc]
         return b"\n".join(fmt)
 
+    # Raw syntax format of lines ``start`` to ``end``. Lines whose format
+    # isn't built yet, or is stale, are None.
+    def get_formats(self, start=0, end=None, offset=TextLine.format.offset):
+        formats = []
+        for line in self.lines[start:end]:
+            fmt = c_char_p.from_address(as_p(line) + offset).value
+            if fmt is not None and len(fmt) != len(line.body):
+                fmt = None
+            formats += fmt,
+        return formats
+
     # The current selection of text in syntax format. Bytes. Read-only.
     @property
     def selected_format(self):
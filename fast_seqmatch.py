@@ -6,6 +6,51 @@ from itertools import compress, repeat, count, islice
 from functools import partial
 from operator import add
 from difflib import SequenceMatcher
+from collections import Counter
+from bisect import bisect_left
+from math import isqrt
+from array import array
+from time import perf_counter
+import sys
+import re
+
+
+# The engine ``unified_diff`` uses when none is passed. One of:
+# 'AUTO'      Pick an engine per call from input size and edit density.
+# 'SEQMATCH'  Always use FastSequenceMatcher.
+# 'MYERS'     Always use MyersSequenceMatcher.
+# 'HISTOGRAM' Always use HistogramSequenceMatcher.
+default_engine = 'AUTO'
+
+# Below this many lines (both sides combined) 'AUTO' uses FastSequenceMatcher.
+MYERS_MIN_SIZE = 1024
+
+# Myers runs in O((N + M) + D²). Bounding D to a multiple of the square root
+# of the input size keeps the D² term linear. Beyond it, 'AUTO' falls back.
+MYERS_EDIT_FACTOR = 8
+
+# Seconds a matcher may spend before giving up on the remaining regions.
+# Unmatched regions become ``replace`` opcodes, so the result is still a
+# valid, if coarser, diff.
+MATCH_TIME_LIMIT = 0.25
+
+# From this many lines (both sides combined) HistogramSequenceMatcher first
+# splits a region at lines unique to both sides.
+HISTOGRAM_SPLIT_SIZE = 1024
+
+# From this many lines (both sides combined) ``get_opcodes`` splits the input
+# at unique common lines and diffs the regions between them in worker
+# processes.
+PARALLEL_MIN_SIZE = 200_000
+
+# The minimum size of the regions diffed separately.
+PARALLEL_REGION_SIZE = 4096
+
+
+# Content-defined chunks for ``split_chunks``. A chunk ends at an anchor
+# character at least 48 characters in, so an edit only moves the boundaries
+# near it. Without anchors, chunks are cut every 1024 characters.
+_chunk_pattern = re.compile(r"(?s).{47,1022}?[\s,;:)\]}/+QqZz]|.{1,1024}")
 
 
 # Does what ``[[] for _ in range(N)]`` does, just faster.
@@ -18,6 +63,56 @@ def map_append(lists, obj):
     return utils.partial(map, list.append)
 
 
+def opcodes_from_blocks(blocks):
+    """Convert a sequence of matching blocks into opcodes."""
+    i = 0
+    j = 0
+    opcodes = []
+
+    for ai, bj, size in blocks:
+        if i < ai and j < bj:
+            opcodes += ("replace", i, ai, j, bj),
+        elif i < ai:
+            opcodes += ("delete",  i, ai, j, bj),
+        elif j < bj:
+            opcodes += ("insert",  i, ai, j, bj),
+
+        if not size:
+            i = ai
+            j = bj
+        else:
+            i = ai + size
+            j = bj + size
+            opcodes += ("equal", ai, i, bj, j),
+
+    return opcodes
+
+
+def coalesce_blocks(matching_blocks, la, lb):
+    """Sort matching blocks, join adjacent ones and add the sentinel."""
+    i1 = 0
+    j1 = 0
+    k1 = 0
+    non_adjacent = []
+
+    for i2, j2, k2 in sorted(matching_blocks):
+        if i1 + k1 == i2 and j1 + k1 == j2:
+            k1 += k2
+
+        else:
+            if k1:
+                non_adjacent += (i1, j1, k1),
+
+            i1 = i2
+            j1 = j2
+            k1 = k2
+    if k1:
+        non_adjacent += (i1, j1, k1),
+
+    non_adjacent += (la, lb, 0),
+    return non_adjacent
+
+
 class FastSequenceMatcher(utils.Variadic, SequenceMatcher):
     isjunk     = None
     opcodes    = None
@@ -42,27 +137,7 @@ class FastSequenceMatcher(utils.Variadic, SequenceMatcher):
             self.b2j = defaultdict_list(b2j)
 
     def get_opcodes(self):
-        i = 0
-        j = 0
-        opcodes = []
-
-        for ai, bj, size in self.get_matching_blocks():
-            if i < ai and j < bj:
-                opcodes += ("replace", i, ai, j, bj),
-            elif i < ai:
-                opcodes += ("delete",  i, ai, j, bj),
-            elif j < bj:
-                opcodes += ("insert",  i, ai, j, bj),
-
-            if not size:
-                i = ai
-                j = bj
-            else:
-                i = ai + size
-                j = bj + size
-                opcodes += ("equal", ai, i, bj, j),
-
-        return opcodes
+        return opcodes_from_blocks(self.get_matching_blocks())
 
     def get_matching_blocks(self):
         a = self.a
@@ -74,6 +149,7 @@ class FastSequenceMatcher(utils.Variadic, SequenceMatcher):
         pool = [(0, la, 0, lb)]
         matching_blocks = []
         islice_a = partial(islice, a)
+        deadline = perf_counter() + MATCH_TIME_LIMIT
 
         for alo, ahi, blo, bhi in iter(pool):
 
@@ -84,6 +160,9 @@ class FastSequenceMatcher(utils.Variadic, SequenceMatcher):
             j2len = {}
             
             for i, c, newj2len in zip(count(alo), islice_a(alo, ahi), infinite_dicts):
+                # Out of time. Keep the longest match so far.
+                if not i & 0x3ff and perf_counter() > deadline:
+                    break
                 if c in b2j:
                     for j in b2j[c]:
                         if j < blo:
@@ -125,37 +204,433 @@ class FastSequenceMatcher(utils.Variadic, SequenceMatcher):
                 if bi + bs < ahi and bj + bs < bhi:
                     pool += (bi + bs, ahi, bj + bs, bhi),
 
-        i1 = 0
-        j1 = 0
-        k1 = 0
-        non_adjacent = []
+            # Leave the remaining regions unmatched. This ends the iteration.
+            if perf_counter() > deadline:
+                pool.clear()
+
+        return coalesce_blocks(matching_blocks, la, lb)
+
+
+class MyersSequenceMatcher(FastSequenceMatcher):
+    """Greedy O((N + M) D) matcher, where D is the number of edits.
+
+    If ``max_edits`` is non-negative and the edit distance exceeds it, or
+    if matching takes longer than ``MATCH_TIME_LIMIT``, the matcher gives up
+    and ``get_opcodes`` returns None.
+    """
 
-        for i2, j2, k2 in sorted(matching_blocks):
-            if i1 + k1 == i2 and j1 + k1 == j2:
-                k1 += k2
+    def __init__(self, a, b, max_edits=-1):
+        self.max_edits = max_edits
+
+    def get_opcodes(self):
+        if (blocks := self.get_matching_blocks()) is not None:
+            return opcodes_from_blocks(blocks)
+        return None
+
+    def get_matching_blocks(self):
+        a = self.a
+        b = self.b
+        la = len(a)
+        lb = len(b)
 
+        max_d = la + lb
+        if 0 <= self.max_edits < max_d:
+            max_d = self.max_edits
+
+        # Furthest reaching x for each diagonal k, offset by ``o``.
+        o = max_d + 1
+        v = [0] * (2 * o + 1)
+
+        # Snapshots of ``v`` for diagonals -d..d after each round.
+        trace = []
+        deadline = perf_counter() + MATCH_TIME_LIMIT
+
+        for d in range(max_d + 1):
+            if perf_counter() > deadline:
+                return None
+
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and v[o + k - 1] < v[o + k + 1]):
+                    x = v[o + k + 1]
+                else:
+                    x = v[o + k - 1] + 1
+                y = x - k
+
+                while x < la and y < lb and a[x] == b[y]:
+                    x += 1
+                    y += 1
+
+                v[o + k] = x
+
+                if x >= la and y >= lb:
+                    trace += v[o - d:o + d + 1],
+                    return self._backtrack(trace, la, lb)
+
+            trace += v[o - d:o + d + 1],
+        return None
+
+    @staticmethod
+    def _backtrack(trace, la, lb):
+        x = la
+        y = lb
+        blocks = []
+
+        for d in range(len(trace) - 1, 0, -1):
+            # The previous round, where diagonal k is at index k + d - 1.
+            prev = trace[d - 1]
+            k = x - y
+
+            # Moved down (insertion) from diagonal k + 1.
+            if k == -d or (k != d and prev[k + d - 2] < prev[k + d]):
+                px = prev[k + d]
+                py = px - k - 1
+                mx = px
+                my = py + 1
+
+            # Moved right (deletion) from diagonal k - 1.
             else:
-                if k1:
-                    non_adjacent += (i1, j1, k1),
+                px = prev[k + d - 2]
+                py = px - k + 1
+                mx = px + 1
+                my = py
+
+            # The snake following the edit.
+            if x > mx:
+                blocks += (mx, my, x - mx),
+            x = px
+            y = py
+
+        # The initial snake starting at (0, 0).
+        if x:
+            blocks += (0, 0, x),
+
+        blocks.reverse()
+        blocks += (la, lb, 0),
+        return blocks
+
+
+class HistogramSequenceMatcher(FastSequenceMatcher):
+    """Histogram diff, as in git. Each region is split at the longest run
+    around the least frequent line common to both sides. Unlike difflib's
+    popularity pruning, repeated lines such as blank lines and closing
+    brackets never anchor a match ahead of a unique line.
+
+    Regions of ``HISTOGRAM_SPLIT_SIZE`` lines or more are first split at
+    lines unique to both sides, or matched using MyersSequenceMatcher if
+    they have none. Regions where every common line occurs more than
+    ``max_chain`` times are matched using FastSequenceMatcher.
+    """
 
-                i1 = i2
-                j1 = j2
-                k1 = k2
-        if k1:
-            non_adjacent += (i1, j1, k1),
+    max_chain = 64
 
-        non_adjacent += (la, lb, 0),
-        return non_adjacent
+    def __init__(self, a, b):
+        pass
+
+    def get_matching_blocks(self):
+        a = self.a
+        b = self.b
+        la = len(a)
+        lb = len(b)
+        max_chain = self.max_chain
+
+        # Sorted positions of each line in ``a``, built once. The occurrences
+        # within a region are found by bisecting them.
+        positions = {}
+        consume(map(list.append, map(positions.setdefault, a, infinite_lists), range(la)))
+
+        pool = [(0, la, 0, lb)]
+        matching_blocks = []
+        deadline = perf_counter() + MATCH_TIME_LIMIT
+
+        for alo, ahi, blo, bhi in iter(pool):
+            if alo == ahi or blo == bhi:
+                continue
+
+            # Split large regions at lines unique to both sides first. These
+            # are the rarest lines, so the histogram would pick them anyway,
+            # but one pass finds all of them instead of one per region.
+            if ahi - alo + bhi - blo >= HISTOGRAM_SPLIT_SIZE and \
+                    (anchors := find_anchors(a[alo:ahi], b[blo:bhi])):
+                i = alo
+                j = blo
+                for anchor_i, anchor_j in anchors:
+                    anchor_i += alo
+                    anchor_j += blo
+                    matching_blocks += (anchor_i, anchor_j, 1),
+                    pool += (i, anchor_i, j, anchor_j),
+                    i = anchor_i + 1
+                    j = anchor_j + 1
+                pool += (i, ahi, j, bhi),
+                continue
+
+            # Without unique lines, large regions are left to Myers unless
+            # the edit distance is too large for it.
+            if ahi - alo + bhi - blo >= HISTOGRAM_SPLIT_SIZE:
+                max_edits = isqrt(ahi - alo + bhi - blo) * MYERS_EDIT_FACTOR
+                myers = MyersSequenceMatcher(a[alo:ahi], b[blo:bhi], max_edits)
+                if (blocks := myers.get_matching_blocks()) is not None:
+                    for i, j, k in blocks:
+                        if k:
+                            matching_blocks += (i + alo, j + blo, k),
+                    continue
+
+            def region_count(line, lo=alo, hi=ahi):
+                p = positions[line]
+                return bisect_left(p, hi) - bisect_left(p, lo)
+
+            bi = alo
+            bj = blo
+            bs = 0
+            best = max_chain + 1
+
+            j = blo
+            while j < bhi:
+                if (p := positions.get(b[j])) is None:
+                    j += 1
+                    continue
+
+                start = bisect_left(p, alo)
+                occurrences = p[start:bisect_left(p, ahi, start)]
+                if not occurrences or len(occurrences) > best:
+                    j += 1
+                    continue
+
+                next_j = j + 1
+                for i in occurrences:
+                    # Extend the run both ways, tracking its rarest line.
+                    rarest = len(occurrences)
+                    si = i
+                    sj = j
+                    while si > alo and sj > blo and a[si - 1] == b[sj - 1]:
+                        si -= 1
+                        sj -= 1
+                        rarest = min(rarest, region_count(a[si]))
+
+                    ei = i + 1
+                    ej = j + 1
+                    while ei < ahi and ej < bhi and a[ei] == b[ej]:
+                        rarest = min(rarest, region_count(a[ei]))
+                        ei += 1
+                        ej += 1
+
+                    if rarest < best or (rarest == best and ei - si > bs):
+                        bi = si
+                        bj = sj
+                        bs = ei - si
+                        best = rarest
+                    next_j = max(next_j, ej)
+                j = next_j
+
+            if bs:
+                matching_blocks += (bi, bj, bs),
+                pool += (alo, bi, blo, bj), (bi + bs, ahi, bj + bs, bhi)
+
+            # No common line is rare enough.
+            else:
+                for i, j, k in FastSequenceMatcher(a[alo:ahi], b[blo:bhi]).get_matching_blocks():
+                    if k:
+                        matching_blocks += (i + alo, j + blo, k),
+
+            # Leave the remaining regions unmatched. This ends the iteration.
+            if perf_counter() > deadline:
+                pool.clear()
+
+        return coalesce_blocks(matching_blocks, la, lb)
+
+
+def intern_lines(a, b) -> tuple[array, array]:
+    """Map each distinct line in ``a`` and ``b`` to a small integer shared by
+    both sequences. Matchers then hash and compare ints instead of strings.
+    """
+    ids = {}
+    # The size of ``ids`` before each lookup, which is the next unused id.
+    sizes = map(len, repeat(ids))
+    return (array("i", map(ids.setdefault, a, sizes)),
+            array("i", map(ids.setdefault, b, sizes)))
+
+
+def split_chunks(string: str) -> list[str]:
+    """Split ``string`` into content-defined chunks for diffing long lines.
+    Unchanged regions produce the same chunks regardless of edits elsewhere.
+    """
+    return _chunk_pattern.findall(string)
+
+
+# Whether large diffs may be split across forked worker processes. Forking
+# Blender is only safe enough on Linux, so this is opt-in and set from the
+# undo preferences.
+use_worker_processes = False
+
+
+def map_in_workers(function, *iterables) -> list | None:
+    """Map ``function`` over ``iterables`` in forked worker processes, which
+    exit once done. Returns None if workers are disabled or unavailable.
+    """
+    if not use_worker_processes or not sys.platform.startswith("linux"):
+        return None
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        # The pool is shut down on exit, so no Blender images stay resident.
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context("fork")) as executor:
+            return list(executor.map(function, *iterables))
+    except Exception:
+        return None
+
+
+def find_anchors(a, b) -> list[tuple[int, int]]:
+    """Return pairs of indices of lines that occur exactly once in both ``a``
+    and ``b``, forming the longest sequence increasing in both.
+    """
+    count_b = Counter(b)
+    unique = {line for line, n in Counter(a).items() if n == 1 and count_b[line] == 1}
+
+    if not unique:
+        return []
+
+    # Index of each unique line in ``b``, and the unique lines in ``a``.
+    j_map = dict(zip(compress(b, map(unique.__contains__, b)),
+                     compress(count(), map(unique.__contains__, b))))
+    i_list = list(compress(count(), map(unique.__contains__, a)))
+    j_list = list(map(j_map.__getitem__, compress(a, map(unique.__contains__, a))))
+
+    # Usually the lines are in the same order, so no sorting is needed.
+    if all(map(int.__lt__, j_list, islice(j_list, 1, None))):
+        return list(zip(i_list, j_list))
+
+    # Patience sorting. ``tails[n]`` is the smallest ``j`` ending a sequence
+    # of length n + 1, and ``links`` the index of each pair's predecessor.
+    tails = []
+    tail_indices = []
+    links = []
+    for index, j in enumerate(j_list):
+        n = bisect_left(tails, j)
+        links += tail_indices[n - 1] if n else -1,
+        if n == len(tails):
+            tails += j,
+            tail_indices += index,
+        else:
+            tails[n] = j
+            tail_indices[n] = index
+
+    anchors = []
+    index = tail_indices[-1]
+    while index != -1:
+        anchors += (i_list[index], j_list[index]),
+        index = links[index]
+    anchors.reverse()
+    return anchors
+
+
+# Worker function. Return the opcodes of each (a, b) region.
+def _diff_regions(regions, engine):
+    return [_get_opcodes(a, b, engine) for a, b in regions]
+
+
+def get_opcodes_parallel(a, b, engine=None):
+    """Return opcodes for ``a`` and ``b`` by diffing the regions between
+    unique common lines, in worker processes if enabled. The result is the same format
+    ``get_opcodes`` returns.
+    """
+    # Region bounds in ``a`` and ``b``. Each anchor line is equal. Anchors
+    # closer than ``PARALLEL_REGION_SIZE`` lines are diffed as regular lines.
+    bounds = []
+    i = j = 0
+    for anchor_i, anchor_j in find_anchors(a, b) + [(len(a), len(b))]:
+        if anchor_i - i + anchor_j - j >= PARALLEL_REGION_SIZE or anchor_i == len(a):
+            bounds += (i, anchor_i, j, anchor_j),
+            i = anchor_i + 1
+            j = anchor_j + 1
+
+    # Split regions into one batch per worker.
+    import os
+    workers = os.cpu_count() or 1
+    batch_size = (len(a) + len(b)) // workers + 1
+    batches = [[]]
+    size = 0
+    for i1, i2, j1, j2 in bounds:
+        if i1 < i2 or j1 < j2:
+            if size >= batch_size:
+                batches += [],
+                size = 0
+            batches[-1] += (a[i1:i2], b[j1:j2]),
+            size += i2 - i1 + j2 - j1
+
+    # Fall back to diffing in-process if workers are disabled or failed.
+    results = None
+    if len(batches) > 1:
+        results = map_in_workers(_diff_regions, batches, repeat(engine))
+    if results is None:
+        results = list(map(_diff_regions, batches, repeat(engine)))
+
+    # Stitch the region opcodes, merging adjacent equal ranges.
+    region_opcodes = iter([opcodes for batch in results for opcodes in batch])
+    opcodes = []
+    for i1, i2, j1, j2 in bounds:
+        if i1 < i2 or j1 < j2:
+            for tag, *indices in next(region_opcodes):
+                opcodes += (tag, *map(add, indices, (i1, i1, j1, j1))),
+        if i2 < len(a):
+            opcodes += ("equal", i2, i2 + 1, j2, j2 + 1),
+
+    merged = []
+    for opcode in opcodes:
+        if merged and opcode[0] == merged[-1][0] == "equal":
+            merged[-1] = ("equal", merged[-1][1], opcode[2], merged[-1][3], opcode[4])
+        else:
+            merged += opcode,
+    return merged
+
+
+def get_opcodes(a, b, engine=None):
+    """Return opcodes for ``a`` and ``b`` using ``engine``, or if None, the
+    module's ``default_engine``. If Myers gives up, FastSequenceMatcher is
+    used instead. Inputs of at least ``PARALLEL_MIN_SIZE`` lines are split
+    and diffed using ``get_opcodes_parallel``.
+    """
+    if len(a) + len(b) >= PARALLEL_MIN_SIZE:
+        return get_opcodes_parallel(a, b, engine)
+    return _get_opcodes(a, b, engine)
+
+
+def _get_opcodes(a, b, engine=None):
+    if engine is None:
+        engine = default_engine
+
+    if engine == 'MYERS':
+        if (opcodes := MyersSequenceMatcher(a, b).get_opcodes()) is not None:
+            return opcodes
+
+    elif engine == 'AUTO':
+        size = len(a) + len(b)
+        if size >= MYERS_MIN_SIZE:
+            max_edits = isqrt(size) * MYERS_EDIT_FACTOR
+
+            # Lines found on only one side must be inserted or deleted, which
+            # makes them a cheap lower bound for the edit distance.
+            if len(set(a).symmetric_difference(b)) <= max_edits:
+                if opcodes := MyersSequenceMatcher(a, b, max_edits).get_opcodes():
+                    return opcodes
+
+    elif engine == 'HISTOGRAM':
+        return HistogramSequenceMatcher(a, b).get_opcodes()
+
+    elif engine != 'SEQMATCH':
+        raise ValueError(f"Expected 'AUTO', 'SEQMATCH', 'MYERS' or 'HISTOGRAM', got {engine!r}")
+
+    return FastSequenceMatcher(a, b).get_opcodes()
 
 
 @utils.inline
-def unified_diff(a, b) -> list[tuple[str, int, int, int, int]]:
+def unified_diff(a, b, engine=None) -> list[tuple[str, int, int, int, int]]:
     """Note: For performance, use this only if you know that `a` != `b`.
     Note 2: Only strings, or list of strings supported.
+    Note 3: ``engine`` is passed to ``get_opcodes``.
     """
 
     from textension.utils import map_ne, filtertrue
-    from .fast_seqmatch import FastSequenceMatcher
+    from .fast_seqmatch import get_opcodes, intern_lines
     from itertools import repeat
     from operator import add, length_hint
     from builtins import len, min, map, reversed
@@ -165,7 +640,7 @@ def unified_diff(a, b) -> list[tuple[str, int, int, int, int]]:
         import operator
         return operator.itemgetter(2, 4)
 
-    def unified_diff(a, b):
+    def unified_diff(a, b, engine=None):
         la = len(a)
         lb = len(b)
         tail = 0
@@ -196,9 +671,12 @@ def unified_diff(a, b) -> list[tuple[str, int, int, int, int]]:
         # Feed only changed lines, then add the offsets to the opcode indices.
         offsets = repeat(head)
 
+        # Match on integer ids instead of the lines themselves.
+        a_ids, b_ids = intern_lines(a[head:old_end], b[head:new_end])
+
         # data[0]  opcode
         # data[1:] indices
-        for data in FastSequenceMatcher(a[head:old_end], b[head:new_end]).get_opcodes():
+        for data in get_opcodes(a_ids, b_ids, engine):
             opcodes += (data[0], *map(add, offsets, data[1:])),
 
         if tail:
@@ -207,3 +685,20 @@ def unified_diff(a, b) -> list[tuple[str, int, int, int, int]]:
         return opcodes
 
     return unified_diff
+
+
+def get_delta_size(opcodes) -> int:
+    """Return the number of lines removed and inserted by ``opcodes``."""
+    return sum(i2 - i1 + j2 - j1 for tag, i1, i2, j1, j2 in opcodes if tag != "equal")
+
+
+def compare_engines(a, b) -> dict[str, tuple[int, float]]:
+    """Diff ``a`` and ``b`` using each engine. Returns the delta size and the
+    seconds taken, per engine.
+    """
+    report = {}
+    for engine in ('SEQMATCH', 'MYERS', 'HISTOGRAM', 'AUTO'):
+        start = perf_counter()
+        size = get_delta_size(unified_diff(a, b, engine))
+        report[engine] = (size, perf_counter() - start)
+    return report
@@ -1,7 +1,7 @@
 """This module implements various operators."""
 
 from .utils import TextOperator, km_def, _call, _system, _context, text_poll
-from .core import iter_brackets, find_word_boundary
+from .core import iter_brackets, enclosing_pair, find_word_boundary
 from .ui import get_mouse_region
 from time import perf_counter
 from .btypes.defs import ST_SCROLL_SELECT
@@ -31,8 +31,10 @@ class TEXTENSION_OT_expand_to_brackets(TextOperator):
 
         l1, c1 = cur.start
         l2, c2 = cur.end
-        type, t1, k1, t2, k2 = find_brackets(
-             text.as_string(), (l1, c1), (l2, c2))
+        if span := enclosing_pair(text, (l1, c1), (l2, c2)):
+            type, (t1, k1), (t2, k2) = span
+        else:
+            return {'CANCELLED'}
 
         pad = 3 if type is TRIPLE else 1
 
@@ -2,7 +2,7 @@
 
 from textension.btypes.defs import OPERATOR_CANCELLED, OPERATOR_FINISHED, OPERATOR_PASS_THROUGH, OPERATOR_RUNNING_MODAL
 from textension.btypes import wmWindowManager, event_type_to_string
-from textension.core import test_line_numbers, iter_brackets, ensure_cursor_view, copy_selection
+from textension.core import test_line_numbers, get_bracket_index, get_syntax_masks, ensure_cursor_view, copy_selection, mark_lines_dirty
 from textension.utils import _context, add_keymap, _call, cm, tag_text_dirty, unsuppress, classproperty, starchain, Aggregation, _named_index, _forwarder, _class_forwarder, filtertrue
 from textension.ui import get_mouse_region
 from textension import utils
@@ -44,6 +44,20 @@ class Default(OpOverride):
     remove_pre  = _class_forwarder("pre_hooks.remove")
     remove_post = _class_forwarder("post_hooks.remove")
 
+    _undo_hint: tuple[int, int] | None = None
+
+    # The (start, end) range of lines an operator edits, set before the edit.
+    # The undo plugin uses it to skip diffing the whole text, and the bracket
+    # and wrap indices to only re-scan those lines.
+    @property
+    def undo_hint(self) -> tuple[int, int] | None:
+        return self._undo_hint
+
+    @undo_hint.setter
+    def undo_hint(self, hint: tuple[int, int]):
+        self._undo_hint = hint
+        mark_lines_dirty(_context.edit_text, *hint)
+
     @classproperty
     def operators(cls):
         for c in Default.__subclasses__():
@@ -103,6 +117,8 @@ class TEXT_OT_insert(Default):
             line = curl
             col  = curc
 
+        self.undo_hint = min(curl, sell), max(curl, sell) + 1
+
         try:
             next_char = body[curc]
         except IndexError:
@@ -134,19 +150,14 @@ class TEXT_OT_insert(Default):
 
                 # .. then check whether we're inside a string
                 # to figure out if we should add a closing quote.
-                line_format = text.lines[sell].format
-
-                in_string = False
-                # Check the line format first, if it exists.
-                if b"l" in line_format and selc < len(line_format):
-                    in_string = line_format[selc] == 108
+                mask = get_syntax_masks(text, sell, sell + 1)[0]
 
+                # Check the mask first. At the line end, whether a string is
+                # unterminated isn't known from the mask.
+                if selc < len(mask):
+                    in_string = mask[selc] != 0
                 else:
-                    for type, start, end in iter_brackets(text.as_string(), strict=False):
-                        # Single or triple quoted string.
-                        if start < (line, col) < end and type > 0:
-                            in_string = True
-                            break
+                    in_string = get_bracket_index(text).in_string(line, col)
 
                 # If the character forms a multi-line bracket, close.
                 if (ml := body[curc - 2: curc] + typed) in {'"""', "'''"} and next_char != typed and \
@@ -350,6 +361,12 @@ class TEXT_OT_delete(Default):
 
                 column += column_offset
 
+                # Deleting past the line end joins the next line. Select up to
+                # its start, so the undo hint covers it.
+                if column > len(text.lines[line].body):
+                    line += 1
+                    column = 0
+
             cursor_post = (endline, endcol)
             delete_to = (line, column)
 
@@ -357,6 +374,9 @@ class TEXT_OT_delete(Default):
         # cursor:      What the cursor extends (selects) before deleting
         if delete_to:
             text.cursor = (*delete_to, *cursor_post)
+
+        lines = curl, sell, cursor_post[0], *delete_to[:1]
+        self.undo_hint = min(lines), max(lines) + 1
         text.write("")
         text.cursor = cursor_post
         
@@ -372,6 +392,7 @@ class TEXT_OT_indent(Default):
         text = _context.edit_text
         tab_width = _context.space_data.tab_width
         ltop, ctop, lbot, cbot = text.cursor_sorted
+        self.undo_hint = ltop, lbot + 1
 
         length = 1
         writestr = "\t"
@@ -455,6 +476,7 @@ class TEXT_OT_paste(Default):
         text = _context.edit_text
         line, column = text.cursor_start
         endline, endcol = line, column
+        self.undo_hint = line, text.cursor_end_line_index + 1
 
         lines = data.count("\n")
         col_move = len(data.splitlines()[-1])
@@ -580,6 +602,7 @@ class TEXT_OT_line_break(Default):
 
         line, col = text.cursor_start
         body = text.lines[line].body
+        self.undo_hint = line, text.cursor_end_line_index + 1
 
         prefix = ""
         # Ctrl is pressed, skip the line break.
@@ -6,6 +6,7 @@ from textension.utils import _context, _system, map_contains, namespace
 from gpu.types import GPUVertBuf, GPUBatch, GPUVertFormat
 from itertools import repeat, islice, compress, count
 from textension import ui, utils
+from textension.core import get_wrap_index, wrap_breaks
 from functools import partial
 from operator import mul, floordiv, sub, add
 from sys import maxsize as int_max
@@ -72,35 +73,20 @@ def to_batch_and_draw(points):
 
 
 # Calculate true top when word wrap is turned on
-def calc_top(lines, line_height, region_height, wrap_offset, max_width):
+def calc_top(text, line_height, region_height, wrap_offset, max_width):
     if max_width < 8:
         max_width = 8
 
-    for idx, line in enumerate(lines):
-        wrap_offset -= line_height
-
-        if wrap_offset < region_height:
-            return idx
-
-        if len(line) < max_width:
-            continue
-
-        pos = 0
-        start = 0
-        end = max_width
-        for pos, c in enumerate(line):
-            if pos - start >= max_width:
-                wrap_offset -= line_height
-                if wrap_offset < region_height:
-                    return idx
-                start = end
-                end += max_width
-            elif c in " -":
-                end = pos + 1
+    # The first row whose offset falls below the region top.
+    row = max(0, (wrap_offset - region_height) // line_height)
+    index = get_wrap_index(text, max_width)
+    line, _ = index.get_line(row)
+    if line < len(index.lines):
+        return line
     return 0
 
 
-def get_scrollbar_points(st, substr, wu, vspan_px, rw, rh, lineh, strings):
+def get_scrollbar_points(st, cache, wu, vspan_px, rw, rh, lineh):
     x1, x2 = utils.get_scrollbar_x_offsets(rw)
 
     # TODO: These offsets are for vanilla scrollbar.
@@ -114,8 +100,10 @@ def get_scrollbar_points(st, substr, wu, vspan_px, rw, rh, lineh, strings):
     if wrh + blank_lines < vispan:
         blank_lines = vispan - wrh
 
-    j = 2.0 + wrhorg / len(strings) * pxavail
-    y_points = compress(count(1), map_contains(strings, repeat(substr)))
+    # Only lines with matches are projected. The set keeps one marker per
+    # pixel row.
+    j = 2.0 + wrhorg / len(cache.lines) * pxavail
+    y_points = map_add(cache.get_match_lines(), repeat(1))
     y_points = map_mul(repeat(j), y_points)
     y_points = map_floordiv(y_points, repeat(wrh + blank_lines))
     y_points = map_sub(repeat(scrolltop), y_points)
@@ -123,6 +111,95 @@ def get_scrollbar_points(st, substr, wu, vspan_px, rw, rh, lineh, strings):
     return zip(repeat(x1), repeat(x2), y_points, map_add(y_points, repeat(2)))
 
 
+def find_all(string, substr) -> list[int]:
+    """Return the columns of non-overlapping occurrences of ``substr``."""
+    columns = []
+    find = string.find
+    step = len(substr)
+    index = find(substr)
+    while index != -1:
+        columns += index,
+        index = find(substr, index + step)
+    return columns
+
+
+class MatchCache:
+    """Lines of a text, lowered unless case sensitive, and the match columns
+    of a needle per line. The text's content string is the version.
+    """
+
+    __slots__ = ("src", "case_sensitive", "needle", "lines", "columns", "match_lines")
+
+    src:            str
+    case_sensitive: bool
+    needle:         str
+    lines:          list[str]
+    columns:        dict[int, list[int]]  # Match columns by line index.
+    match_lines:    list[int]             # Indices of lines with matches.
+
+    def __init__(self):
+        self.src = None
+        self.case_sensitive = None
+        self.needle = None
+        self.lines = []
+        self.columns = {}
+        self.match_lines = None
+
+    def get_match_lines(self) -> list[int]:
+        if self.match_lines is None:
+            contains = map_contains(self.lines, repeat(self.needle))
+            self.match_lines = list(compress(count(), contains))
+        return self.match_lines
+
+    def get_columns(self, index: int) -> list[int]:
+        try:
+            return self.columns[index]
+        except KeyError:
+            columns = self.columns[index] = find_all(self.lines[index], self.needle)
+            return columns
+
+
+_match_caches: dict[int, MatchCache] = {}
+
+
+# Remove the match caches of all texts, since they belong to the previous
+# file. This is called via bpy.app.handlers.load_post.
+@bpy.app.handlers.persistent
+def purge_match_caches(*unused_args) -> None:
+    _match_caches.clear()
+
+
+# Remove the match cache of the text about to be unlinked.
+def unlink_pre() -> None:
+    _match_caches.pop(_context.edit_text.id, None)
+
+
+def get_match_cache(text, needle: str) -> MatchCache:
+    """Return the match cache of ``text`` for ``needle``. The lines are only
+    split again when the content or case sensitivity changed.
+    """
+    try:
+        cache = _match_caches[text.id]
+    except KeyError:
+        cache = _match_caches[text.id] = MatchCache()
+
+    src = text.as_string()
+    case_sensitive = prefs.case_sensitive
+    if src != cache.src or case_sensitive != cache.case_sensitive:
+        cache.src = src
+        cache.case_sensitive = case_sensitive
+        if not case_sensitive:
+            src = src.lower()
+        cache.lines = src.splitlines()
+        cache.needle = None
+
+    if needle != cache.needle:
+        cache.needle = needle
+        cache.columns = {}
+        cache.match_lines = None
+    return cache
+
+
 def get_match_points(st, substr, start, end):
     is_wrapped = st.show_word_wrap
     line_height = st.runtime.lheight_px
@@ -132,11 +209,8 @@ def get_match_points(st, substr, start, end):
     scrollpts = []
     text = st.text
 
-    src = text.as_string()
-    if not prefs.case_sensitive:
-        src = src.lower()
-
-    lines = src.splitlines()
+    cache = get_match_cache(text, substr)
+    lines = cache.lines
 
     loc = st.region_location_from_cursor
     first_y = loc(0, 0)[1]
@@ -162,7 +236,7 @@ def get_match_points(st, substr, start, end):
         if max_width < 8:
             max_width = 8
 
-        top = calc_top(lines, line_height, rh, first_y + y_offset, max_width)
+        top = calc_top(text, line_height, rh, first_y + y_offset, max_width)
 
     elif st.left:
         x_offset -= st.left * cw
@@ -182,48 +256,39 @@ def get_match_points(st, substr, start, end):
 
     # Generate points for scrollbar highlights
     if prefs.show_in_scrollbar:
-        scrollpts = get_scrollbar_points(st, substr, wunits, vspan_px, rw, rh, line_height, lines)
+        scrollpts = get_scrollbar_points(st, cache, wunits, vspan_px, rw, rh, line_height)
 
     bottom = top + st.visible_lines + 4
     curl = text.current_line_index
-    if top <= curl < bottom:
-        body = lines[curl]
-        body = body[:start] + ("\x00" * (end - start)) + body[end:]
-        lines[text.current_line_index] = body
 
     strlen = len(substr)
     width = cw * strlen
 
     # Generate points for text highlights
-    for line in islice(lines, top, bottom):
-        wrap_count = 0
+    for line_index, line in enumerate(islice(lines, top, bottom), top):
+        # Mask the selection so it isn't highlighted.
+        if line_index == curl:
+            line = line[:start] + ("\x00" * (end - start)) + line[end:]
+            columns = find_all(line, substr)
+        else:
+            columns = cache.get_columns(line_index)
+
         wrap_indices = []
         linelen = len(line)
 
         # Nothing to wrap.
         if linelen <= max_width:
-            wrap_end = linelen
-
+            starts = (0,)
         else:
-            wrap_start = 0
-            wrap_end = max_width
-            for idx, char in enumerate(line):
-                if idx - wrap_start >= max_width:
-                    wrap_indices += zip(range(wrap_end - wrap_start), repeat(wrap_count))
-                    wrap_count += 1
-                    wrap_start = wrap_end
-                    wrap_end += max_width
-                elif char in " -":
-                    wrap_end = idx + 1
-            wrap_end = linelen - wrap_start
-
-        wrap_indices += zip(range(wrap_end), repeat(wrap_count))
+            starts = wrap_breaks(line, max_width)
 
-        # Find matches.
-        if substr in line and linelen < 65536:
-            i = line.index(substr, 0)
+        wrap_count = len(starts) - 1
+        for wrap_line, wrap_start, wrap_end in zip(count(), starts, starts[1:] + (linelen,)):
+            wrap_indices += zip(range(wrap_end - wrap_start), repeat(wrap_line))
 
-            while i is not -1:
+        # Find matches.
+        if columns and linelen < 65536:
+            for i in columns:
                 # Region coords for wrapped char/line by match index
                 wrap_char, wrap_line = wrap_indices[i]
                 y = y_table[wrap_line] - wrap_offset
@@ -246,7 +311,6 @@ def get_match_points(st, substr, start, end):
                     x2 = x_table[wrap_char] + cw
 
                 points += (x, x2, y, y + line_height),
-                i = line.find(substr, wrap_index)
 
         total_lines += wrap_count + 1
         wrap_offset = line_height * total_lines
@@ -421,6 +485,11 @@ def enable():
     # The new editor scrollbar uses draw index 10. This draws on top.
     ui.add_draw_hook(draw_match, draw_index=11)
 
+    bpy.app.handlers.load_post.append(purge_match_caches)
+
+    from textension.overrides.default import TEXT_OT_unlink
+    TEXT_OT_unlink.add_pre(unlink_pre, is_global=True)
+
 
 def disable():
     from textension.prefs import remove_settings
@@ -432,3 +501,9 @@ def disable():
     prefs = None
     ui.remove_draw_hook(draw_match)
     runtime.reset()
+
+    bpy.app.handlers.load_post.remove(purge_match_caches)
+
+    from textension.overrides.default import TEXT_OT_unlink
+    TEXT_OT_unlink.remove_pre(unlink_pre)
+    purge_match_caches()
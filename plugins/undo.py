@@ -13,11 +13,15 @@ from textension import utils, overrides
 from itertools import compress
 
 import bpy
+import sys
+import os
 
 
 _context = utils._context
 _data    = utils._data
 
+prefs: "TEXTENSION_PG_undo" = None
+
 undo_stacks: dict[int, utils.UndoStack] = {}
 
 
@@ -31,6 +35,9 @@ _applied_default_undos = []
 _stack_sync_ids = set()
 _stack_sync_map = {}
 
+# Map of text ids to history files not yet loaded.
+_pending_history: dict[int, str] = {}
+
 
 # Examines the last type character and determine if an undo that would
 # otherwise be grouped, should be split.
@@ -85,6 +92,12 @@ class TextAdapter(utils.Adapter):
     def get_cursor(self):
         return self.text.cursor2
 
+    def get_lines(self, start: int, end: int) -> list[str]:
+        return [line.body for line in self.text.lines[start:end]]
+
+    def get_line_count(self) -> int:
+        return len(self.text.lines)
+
     def set_cursor(self, cursor):
         self.text.cursor = cursor
 
@@ -92,6 +105,42 @@ class TextAdapter(utils.Adapter):
     def set_string(self, string: str) -> None:
         return utils._forwarder("text.from_string")
 
+    # Replace only the changed lines, leaving the rest of the text untouched.
+    def patch(self, changes) -> bool:
+        text = self.text
+
+        for start, end, content in changes:
+            lines = text.lines
+            string = "\n".join(content)
+
+            # Insertion. At the end of the text, insert after the last line.
+            if start == end:
+                if not content:
+                    continue
+                if start < len(lines):
+                    select = (start, 0, start, 0)
+                    string += "\n"
+                else:
+                    eol = len(lines[-1].body)
+                    select = (start - 1, eol, start - 1, eol)
+                    string = "\n" + string
+
+            # Deletion. Remove the line breaks of deleted lines as well.
+            elif not content:
+                if end < len(lines):
+                    select = (start, 0, end, 0)
+                elif start > 0:
+                    select = (start - 1, len(lines[start - 1].body), end - 1, len(lines[end - 1].body))
+                else:
+                    return False
+
+            else:
+                select = (start, 0, end - 1, len(lines[end - 1].body))
+
+            text.select_set(*select)
+            text.write(string)
+        return True
+
     def get_should_split(self, hint: bool) -> bool:
         return _should_split(self.text)
 
@@ -149,6 +198,13 @@ def map_cursor_updates(stacks):
     return utils.partial_map(update_cursors)
 
 
+# Whether ``text`` matches the state of its undo stack. Blender's undo can
+# re-read a changed text into lines at the same addresses, so pointers can't
+# tell. Comparing the content runs in C and is far cheaper than restoring.
+def is_text_in_sync(text: bpy.types.Text, stack: utils.UndoStack) -> bool:
+    return text.as_string() == stack.state.join("\n")
+
+
 # Called before undo/redo/undo_history.
 # This preserves the texts so they can be recovered.
 @utils.unsuppress
@@ -168,9 +224,12 @@ def sync_post() -> None:
     saved_ids = map_synced_ids(map_ids_from_texts(_data.texts))
     _data.batch_remove(compress(_data.texts, map_not(saved_ids)))
 
-    # Restore texts Blender removed from its undo/redo step.
-    for stack in tuple(undo_stacks.values()):
-        stack.restore_last()
+    # Restore texts Blender removed or changed in its undo/redo step.
+    texts = dict(zip(map_ids_from_texts(_data.texts), _data.texts))
+    for text_id, stack in tuple(undo_stacks.items()):
+        text = texts.get(text_id)
+        if not text or not is_text_in_sync(text, stack):
+            stack.restore_last()
 
     # Restore the assigned texts to open editors.
     for st in iter_spaces(space_type='TEXT_EDITOR'):
@@ -180,6 +239,86 @@ def sync_post() -> None:
     _stack_sync_ids.clear()
 
 
+def get_memory_usage() -> int:
+    """Return the approximate size in bytes of the undo history of all texts.
+    The size of each stack is available as ``UndoStack.size``, and of each
+    step as ``Step.size``.
+    """
+    return sum(map(utils.attrgetter("size"), undo_stacks.values()))
+
+
+# Evict the oldest steps of the least recently used stacks until the total
+# size of all stacks is within the memory budget.
+def enforce_memory_budget() -> None:
+    if not prefs:
+        return
+
+    budget = prefs.memory_budget * 1024 ** 2
+    usage = get_memory_usage()
+
+    if usage > budget:
+        for stack in sorted(undo_stacks.values(), key=utils.attrgetter("last_access")):
+            while usage > budget and (freed := stack.evict()) is not None:
+                usage -= freed
+
+            if usage <= budget:
+                break
+
+
+# Timer callback. Compress cold steps of all stacks.
+def compact_stacks() -> float:
+    consume(map(utils.UndoStack.compact, undo_stacks.values()))
+    return utils.UndoStack.freeze_idle
+
+
+# Return the directory of history files for the current blend file.
+def get_history_dir() -> str:
+    if filepath := _data.filepath:
+        return filepath + ".undo"
+    return ""
+
+
+# Load the history file of a stack, if it has one. Histories are loaded on
+# the first undo so that opening blend files isn't slowed down.
+def load_history(stack: utils.UndoStack) -> None:
+    if stack and (path := _pending_history.pop(stack.adapter.id, None)):
+        try:
+            with open(path, "rb") as file:
+                if not stack.loads(file.read()):
+                    print(f"Textension: Undo history of '{stack.adapter.name}' is out of date")
+        except:
+            import traceback
+            traceback.print_exc()
+        else:
+            enforce_memory_budget()
+
+
+# Write the history of all texts next to the blend file.
+# This is called via bpy.app.handlers.save_post.
+@bpy.app.handlers.persistent
+def save_history(*unused_args) -> None:
+    if not (prefs and prefs.use_persistent_history):
+        return
+
+    # Histories not yet loaded would otherwise be overwritten.
+    consume(map(load_history, tuple(undo_stacks.values())))
+
+    directory = get_history_dir()
+    os.makedirs(directory, exist_ok=True)
+    stale = set(os.listdir(directory))
+
+    for text_id, stack in undo_stacks.items():
+        if len(stack.undo) > 1 or stack.redo:
+            name = f"{text_id}.undo"
+            with open(os.path.join(directory, name), "wb") as file:
+                file.write(stack.dumps())
+            stale.discard(name)
+
+    for name in stale:
+        if name.endswith(".undo"):
+            os.remove(os.path.join(directory, name))
+
+
 # Purge stacks and create new for any text blocks.
 # This is called via bpy.app.handlers.load_post.
 @bpy.app.handlers.persistent
@@ -191,6 +330,14 @@ def purge(*unused_args) -> None:
     undo_stacks.clear()
     consume(map_undo_stacks(_data.texts))
 
+    _pending_history.clear()
+    if prefs and prefs.use_persistent_history:
+        if os.path.isdir(directory := get_history_dir()):
+            files = set(os.listdir(directory))
+            for text_id in undo_stacks:
+                if (name := f"{text_id}.undo") in files:
+                    _pending_history[text_id] = os.path.join(directory, name)
+
 
 # Method wrapper for python operators. Similar to the C-method wrapper below.
 def pyop_wrapper(context, op=None, event=None, method=None) -> int:
@@ -205,6 +352,7 @@ def pyop_wrapper(context, op=None, event=None, method=None) -> int:
 
     if result == defs.OPERATOR_FINISHED:
         stack.push(tag=op.contents.idname.decode())
+        enforce_memory_budget()
         # Prevent Blender from pushing its own undo.
         result = defs.OPERATOR_CANCELLED
     return result
@@ -242,7 +390,10 @@ def get_active_stack() -> utils.UndoStack:
 
 
 def undo_poll() -> bool:
-    return get_active_stack().poll_undo()
+    stack = get_active_stack()
+    if _pending_history:
+        load_history(stack)
+    return stack.poll_undo()
 
 
 def redo_poll() -> bool:
@@ -312,7 +463,8 @@ def _apply_default_undo() -> None:
                 else:
                     # Operator finished, push a step, ignore native undo.
                     if result == defs.OPERATOR_FINISHED:
-                        stack.push(tag=cls.__name__)
+                        stack.push(tag=cls.__name__, hint=self.undo_hint)
+                        enforce_memory_budget()
                         result = defs.OPERATOR_CANCELLED
                 finally:
                     return result
@@ -329,7 +481,69 @@ def _remove_default_undo() -> None:
     _applied_default_undos.clear()
 
 
+def update_parallel_diff(self, context):
+    from textension import fast_seqmatch
+    fast_seqmatch.use_worker_processes = self.use_parallel_diff
+
+
+class TEXTENSION_PG_undo(bpy.types.PropertyGroup):
+    memory_budget: bpy.props.IntProperty(
+        description="Maximum memory used by the undo history of all texts. "
+                    "When exceeded, the oldest steps of the least recently "
+                    "used texts are discarded",
+        name="Memory Budget (MB)",
+        default=256,
+        min=1,
+        update=utils.tag_userdef_modified,
+    )
+    use_persistent_history: bpy.props.BoolProperty(
+        description="Save the undo history of texts next to the blend file "
+                    "and restore it when the file is opened again",
+        name="Persistent History",
+        default=False,
+        update=utils.tag_userdef_modified,
+    )
+
+    use_parallel_diff: bpy.props.BoolProperty(
+        description="Diff very large texts in forked worker processes. Only "
+                    "available on Linux. Workers exit after each diff",
+        name="Parallel Diff",
+        default=False,
+        update=utils.tag_userdef_modified_wrapper(update_parallel_diff),
+    )
+
+
+def draw_settings(prefs, context, layout):
+    self = prefs.undo
+    layout.use_property_split = True
+    layout.use_property_decorate = False
+
+    layout.prop(self, "memory_budget")
+    layout.prop(self, "use_persistent_history")
+
+    row = layout.row()
+    row.active = sys.platform.startswith("linux")
+    row.prop(self, "use_parallel_diff")
+
+    layout.separator()
+
+    usage = get_memory_usage() / 1024 ** 2
+    row = layout.row()
+    row.alignment = 'RIGHT'
+    row.label(text=f"Using {usage:.2f} MB across {len(undo_stacks)} texts")
+
+
 def enable() -> None:
+    from textension.prefs import add_settings
+
+    utils.register_class(TEXTENSION_PG_undo)
+
+    global prefs
+    prefs = add_settings(TEXTENSION_PG_undo)
+
+    from textension import fast_seqmatch
+    fast_seqmatch.use_worker_processes = prefs.use_parallel_diff
+
     # Registered TextOperators.
     for cls in utils.TextOperator.__subclasses__():
         if cls.is_registered:
@@ -359,6 +573,10 @@ def enable() -> None:
 
     # Register handler that purges all undo states between blend file loads.
     bpy.app.handlers.load_post.append(purge)
+    bpy.app.handlers.save_post.append(save_history)
+
+    # Compress steps that haven't been touched in a while.
+    bpy.app.timers.register(compact_stacks, persistent=True)
 
     from textension.overrides.default import TEXT_OT_unlink, TEXT_OT_new, TEXT_OT_save, TEXT_OT_save_as, TEXT_OT_resolve_conflict
     TEXT_OT_unlink.add_pre(unlink_pre, is_global=True)
@@ -398,4 +616,20 @@ def disable() -> None:
     _remove_default_undo()
 
     purge()
+    _pending_history.clear()
     bpy.app.handlers.load_post.remove(purge)
+    bpy.app.handlers.save_post.remove(save_history)
+
+    if bpy.app.timers.is_registered(compact_stacks):
+        bpy.app.timers.unregister(compact_stacks)
+
+    from textension import fast_seqmatch
+    fast_seqmatch.use_worker_processes = False
+
+    from textension.prefs import remove_settings
+
+    utils.unregister_class(TEXTENSION_PG_undo)
+    remove_settings(TEXTENSION_PG_undo)
+
+    global prefs
+    prefs = None
@@ -8,6 +8,10 @@ import operator
 import ctypes
 import idprop
 import types
+import pickle
+import json
+import zlib
+import hashlib
 import bpy
 
 try:
@@ -22,10 +26,10 @@ from typing import Callable
 from types import CellType, FunctionType
 
 from operator import attrgetter
-from itertools import compress, starmap, repeat
+from itertools import accumulate, chain, compress, starmap, repeat
 from functools import partial
 
-from sys import _getframe
+from sys import _getframe, getsizeof, intern
 from time import monotonic
 
 from typing import TypeVar
@@ -154,6 +158,13 @@ def map_len(seq):
     return partial_map(len)
 
 
+# Map strings to their canonical interned objects. Interned strings are
+# released when nothing else references them.
+@inline
+def map_intern(strings):
+    return partial_map(intern)
+
+
 @inline
 def map_areas_from_windows(windows):
     return partial(map, attrgetter("screen.areas"))
@@ -828,6 +839,20 @@ class Adapter:
     def get_should_split(self, hint: bool) -> bool:
         return bool
 
+    # Return the lines in the range ``start:end`` of the current string.
+    # Adapters with direct access to lines should override these.
+    def get_lines(self, start: int, end: int) -> list[str]:
+        return self.get_string().split("\n")[start:end]
+
+    def get_line_count(self) -> int:
+        return self.get_string().count("\n") + 1
+
+    # Apply a sequence of (start, end, lines) replacements, in order, to the
+    # current lines. Return False if not supported, or if a replacement can't
+    # be applied, in which case the stack falls back to ``set_string``.
+    def patch(self, changes) -> bool:
+        return False
+
     # Update hook on stack initialization and undo push.
     @inline
     def on_update(self, restore=False):
@@ -849,14 +874,198 @@ class Adapter:
         return f"{type(self).__name__}"
 
 
+class Fenwick:
+    """Binary indexed tree of non-negative integers, with O(log n) updates,
+    prefix sums and prefix sum searches.
+    """
+    __slots__ = ("tree",)
+
+    # 1-based. Each node holds the sum of a power-of-two range ending at it.
+    tree: list[int]
+
+    def __init__(self, values=()):
+        self.tree = tree = [0, *values]
+        size = len(tree)
+        for index in range(1, size):
+            if (parent := index + (index & -index)) < size:
+                tree[parent] += tree[index]
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def __getitem__(self, index: int) -> int:
+        return self.prefix(index + 1) - self.prefix(index)
+
+    def add(self, index: int, delta: int) -> None:
+        """Add ``delta`` to the value at ``index``."""
+        tree = self.tree
+        size = len(tree)
+        index += 1
+        while index < size:
+            tree[index] += delta
+            index += index & -index
+
+    def prefix(self, end: int) -> int:
+        """Return the sum of values before ``end``."""
+        tree = self.tree
+        result = 0
+        while end > 0:
+            result += tree[end]
+            end &= end - 1
+        return result
+
+    def find(self, value: int) -> tuple[int, int]:
+        """Return the index whose range of the running sum contains ``value``,
+        and the remainder of ``value`` within it.
+        """
+        tree = self.tree
+        size = len(tree)
+        index = 0
+        step = 1 << (size - 1).bit_length()
+        while step:
+            if (next_index := index + step) < size and tree[next_index] <= value:
+                index = next_index
+                value -= tree[index]
+            step >>= 1
+        return index, value
+
+    def copy(self) -> "Fenwick":
+        new = Fenwick.__new__(Fenwick)
+        new.tree = self.tree.copy()
+        return new
+
+
+class LineRope:
+    """A list of lines stored as chunks of tuples.
+
+    Replacing a range of lines copies only the chunks it touches. Chunks are
+    located using a Fenwick tree of their lengths, so a replacement that
+    doesn't change the number of chunks is O(log n) plus the chunk size.
+    Chunks are immutable, so ``copy`` is a cheap snapshot.
+    """
+    __slots__ = ("chunks", "index")
+
+    chunks: list[tuple[str]]
+    index:  Fenwick
+
+    chunk_size = 512
+
+    def __init__(self, lines=()):
+        lines = tuple(lines)
+        size = self.chunk_size
+        self.chunks = [lines[i:i + size] for i in range(0, len(lines), size)]
+        self.index = Fenwick(map(len, self.chunks))
+
+    def __len__(self):
+        return self.index.prefix(len(self.chunks))
+
+    def __iter__(self):
+        return chain.from_iterable(self.chunks)
+
+    def __reversed__(self):
+        return chain.from_iterable(map(reversed, reversed(self.chunks)))
+
+    def __getitem__(self, key):
+        if key.__class__ is slice:
+            start, end, step = key.indices(len(self))
+            assert step == 1, "Extended slices not supported"
+            lines = []
+            if start < end:
+                chunk, offset = self.index.find(start)
+                end -= start - offset
+                for lines_chunk in self.chunks[chunk:]:
+                    lines += lines_chunk[offset:end]
+                    if (end := end - len(lines_chunk)) <= 0:
+                        break
+                    offset = 0
+            return lines
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("line index out of range")
+        chunk, offset = self.index.find(key)
+        return self.chunks[chunk][offset]
+
+    def __setitem__(self, key: slice, lines):
+        start, end, step = key.indices(length := len(self))
+        assert step == 1, "Extended slices not supported"
+        end = max(start, end)
+        chunks = self.chunks
+
+        # The chunks containing the first and last replaced lines. Insertions
+        # at the end are added to the last chunk.
+        if start < length:
+            first, head = self.index.find(start)
+        else:
+            first = max(0, len(chunks) - 1)
+            head = len(chunks[first]) if chunks else 0
+
+        if end > start:
+            last, tail = self.index.find(end - 1)
+            tail += 1
+        else:
+            last, tail = first, head
+
+        new = tuple(lines)
+        if chunks:
+            new = chunks[first][:head] + new + chunks[last][tail:]
+
+        size = self.chunk_size
+        if len(new) <= size * 2:
+            pieces = [new] if new else []
+        else:
+            pieces = [new[i:i + size] for i in range(0, len(new), size)]
+
+        replaced = len(chunks[first:last + 1])
+        chunks[first:last + 1] = pieces
+
+        # Update the index in place when the number of chunks is unchanged.
+        if len(pieces) == replaced:
+            index = self.index
+            for i, piece in enumerate(pieces, first):
+                index.add(i, len(piece) - index[i])
+        else:
+            self.index = Fenwick(map(len, chunks))
+
+    def copy(self) -> "LineRope":
+        new = LineRope.__new__(LineRope)
+        new.chunks = self.chunks.copy()
+        new.index = self.index.copy()
+        return new
+
+    def join(self, separator: str) -> str:
+        """Join the lines using ``separator``."""
+        return separator.join(map(separator.join, self.chunks))
+
+    def __repr__(self):
+        return f"<LineRope lines={len(self)} chunks={len(self.chunks)}>"
+
+
 class UndoStack:
-    __slots__ = ("undo", "redo", "last_push", "adapter", "state")
+    __slots__ = ("undo", "redo", "last_push", "adapter", "state", "size", "last_access")
 
     undo:  list["Step"]
     redo:  list["Step"]
 
-    # The current state of a text as a list of strings.
-    state: list[str]
+    # The current state of a text as lines.
+    state: LineRope
+
+    # The approximate size in bytes of all steps in ``undo`` and ``redo``.
+    size:  int
+
+    # Monotonic time of the last push, undo or redo.
+    last_access: float
+
+    # Steps further than this from the top of either stack are compressed.
+    freeze_distance = 16
+
+    # Seconds without access after which ``compact`` compresses all steps.
+    freeze_idle = 30.0
+
+    # Maximum number of lines removed and inserted by a step for it to be
+    # applied using ``Adapter.patch`` instead of ``Adapter.set_string``.
+    patch_limit = 256
 
     def reset(self):
         """Reset stacks."""
@@ -865,13 +1074,20 @@ class UndoStack:
     def __init__(self, adapter: Adapter):
         self.undo  = []
         self.redo  = []
-        self.state = []
+        self.state = LineRope()
 
         self.adapter = adapter
         self.last_push = 0.0
+        self.last_access = monotonic()
+        self.size = 0
 
-        # The initial state.
+        # The initial state. Its data is never applied, so it's dropped and
+        # the stack's size only counts the history.
         self.push(tag="init")
+        init = self.undo[0]
+        init.data = []
+        self.size -= init.size
+        init.size = 0
 
     def pop_undo(self) -> bool:
         # We don't use ``self.poll_undo()`` here, because the stack can still
@@ -900,51 +1116,144 @@ class UndoStack:
         if self.adapter.is_valid:
             self._apply(self.undo[-1].cursor[1], True)
 
-    # Step the stack. When ``reverse`` is True, pop from undo stack.
+    # Step the stack. When ``steps`` is negative, pop from undo stack.
     def _step(self, steps: int):
-        src = self.redo
-        dst = self.undo
+        # All steps in order. The state is that after ``timeline[current]``.
+        timeline = self.undo + self.redo[::-1]
+        current = len(self.undo) - 1
+        target = current + steps
 
         if is_reverse := steps < 0:
-            src, dst = dst, src
+            replay = reversed(timeline[target + 1:current + 1])
+        else:
+            replay = timeline[current + 1:target + 1]
 
-        # The end slice of ``src``.
-        chunk = slice(-abs(steps), None)
+        changes = []
+        for step in replay:
+            self.size += step.thaw()
+            changes += step.apply(self.state, is_reverse)
 
-        for step in reversed(src[chunk]):
-            for data in step.data:
-                start, end, content = data[is_reverse]
-                self.state[start:end] = content
-            dst += step,
+        self.undo[:] = timeline[:target + 1]
+        self.redo[:] = timeline[:target:-1]
+        self.last_access = monotonic()
 
-        del src[chunk]
+        # Large changes are faster to apply as a whole.
+        if sum(end - start + len(content) for start, end, content in changes) > self.patch_limit:
+            changes = None
 
-        # On undo, apply the secondary cursor from the end of ``src``.
-        # On redo, apply the first cursor from the end of ``dst``.
-        cursor = (dst, src)[is_reverse][-1].cursor[is_reverse]
-        self._apply(cursor, is_reverse)
+        # On undo, apply the secondary cursor of the last undo step.
+        # On redo, apply its first cursor.
+        is_reverse = steps < 0
+        self._apply(self.undo[-1].cursor[is_reverse], is_reverse, changes)
 
-    def _apply(self, cursor, restore):
-        self.adapter.set_string("\n".join(self.state))
+    def _apply(self, cursor, restore, changes=None):
+        if changes is None or not self.adapter.patch(changes):
+            self.adapter.set_string(self.state.join("\n"))
         self.adapter.set_cursor(cursor)
         self.adapter.on_update(restore=restore)
 
-    def push(self, tag, *, can_group=True):
-        """If ``can_group`` is True, allow merging similar states."""
+    def push(self, tag, *, can_group=True, hint=None):
+        """If ``can_group`` is True, allow merging similar states.
+
+        ``hint`` is an optional (start, end) range of lines in the current
+        state the edit is confined to. Lines outside it are not diffed.
+        """
 
         if self.undo:
             can_group &= tag == self.undo[-1].tag
 
         now = monotonic()
         if not can_group or now - self.last_push > 0.5 or self.adapter.get_should_split(can_group):
-            self.undo += Step(self, tag=tag),
+            self.undo += Step(self, tag=tag, hint=hint),
         else:
-            self.undo[-1].merge(self)
+            self.size -= self.undo[-1].size
+            self.undo[-1].merge(self, hint=hint)
 
+        self.size += self.undo[-1].size - sum(map(attrgetter("size"), self.redo))
         self.redo.clear()
+
+        if len(self.undo) > self.freeze_distance:
+            self.size += self.undo[-1 - self.freeze_distance].freeze()
+
         self.last_push = now
+        self.last_access = now
         self.adapter.on_update()
 
+    def compact(self) -> int:
+        """Compress steps further than ``freeze_distance`` from the top of
+        either stack, or all steps if the stack has been idle for longer than
+        ``freeze_idle`` seconds. Returns the bytes saved.
+        """
+        keep = self.freeze_distance
+        if monotonic() - self.last_access > self.freeze_idle:
+            keep = 0
+
+        size = self.size
+        for steps in (self.undo, self.redo):
+            for step in steps[:max(0, len(steps) - keep)]:
+                self.size += step.freeze()
+        return size - self.size
+
+    def evict(self) -> int | None:
+        """Discard the oldest undo step, or if there are none, the furthest
+        redo step. Returns the bytes freed, or None if nothing was evicted.
+        """
+        if len(self.undo) > 1:
+            init, step = self.undo[0], self.undo.pop(1)
+
+            # The initial step now represents the state after ``step``.
+            freed = step.size
+            init.cursor[1] = step.cursor[1]
+
+        elif self.redo:
+            freed = self.redo.pop(0).size
+
+        else:
+            return None
+
+        self.size -= freed
+        return freed
+
+    def dumps(self) -> bytes:
+        """Serialize the steps into bytes. The result can be restored using
+        ``loads`` by a stack whose initial state is this stack's current.
+        """
+        init, *undo = self.undo
+        # The initial step's data is never applied, so it's not stored.
+        undo = [[init.tag, list(map(list, init.cursor)), []]] + list(map(Step.to_record, undo))
+        redo = list(map(Step.to_record, self.redo))
+        record = [get_state_hash(self.state).hex(), undo, redo]
+        # JSON, since the file may be shared along with the blend file and
+        # must not be able to execute code when loaded.
+        return zlib.compress(json.dumps(record, separators=(",", ":")).encode())
+
+    def loads(self, blob: bytes) -> bool:
+        """Restore steps serialized with ``dumps`` and put them before this
+        stack's own. Returns False if the serialized history doesn't lead up
+        to the initial state of this stack. Raises ValueError if ``blob`` is
+        malformed.
+        """
+        state_hash, undo, redo = _check_sequence(json.loads(zlib.decompress(blob)), 3)
+        undo = list(map(Step.from_record, _check_sequence(undo)))
+        redo = list(map(Step.from_record, _check_sequence(redo)))
+        if not undo or state_hash.__class__ is not str:
+            raise ValueError("Malformed undo history")
+
+        # Rewind a copy of the state to the initial step.
+        lines = self.state.copy()
+        for step in reversed(self.undo[1:]):
+            step.apply(lines, True)
+
+        if state_hash != get_state_hash(lines).hex():
+            return False
+
+        self.undo[:1] = undo
+        if len(self.undo) == len(undo):
+            self.redo[:] = redo
+
+        self.size = sum(map(attrgetter("size"), self.undo + self.redo))
+        return True
+
     def update_cursor(self):
         if self.undo:
             self.undo[-1].cursor[1] = self.adapter.get_cursor()
@@ -961,24 +1270,285 @@ class UndoStack:
         return f"<UndoStack ({self.adapter}) at 0x{id(self):0>16X}>"
 
 
+# The approximate cost of a stored line: string header and a list slot.
+_line_overhead = getsizeof("") + 8
+
+
+def get_content_size(lines: list[str]) -> int:
+    """Return the approximate size in bytes of a list of lines."""
+    if lines.__class__ is LinePatch:
+        return lines.get_size()
+    elif lines.__class__ is LineRef:
+        return _line_overhead
+    return sum(map(len, lines)) + len(lines) * _line_overhead
+
+
+class LinePatch(tuple):
+    """Character edits of a single line as (start, end, string) tuples in
+    descending order. Step data stores these instead of whole lines when
+    parts of a long line changed.
+    """
+    __slots__ = ()
+
+    def apply(self, line: str) -> str:
+        parts = []
+        position = 0
+        for start, end, string in reversed(self):
+            parts += line[position:start], string
+            position = end
+        parts += line[position:],
+        return "".join(parts)
+
+    def get_size(self) -> int:
+        return sum(len(edit[2]) for edit in self) + len(self) * _line_overhead
+
+    @classmethod
+    def from_affixes(cls, old: str, new: str) -> tuple["LinePatch", "LinePatch"]:
+        """Return single edit patches turning ``old`` into ``new`` and back,
+        from the common prefix and suffix of the two.
+        """
+        prefix = get_common_prefix_length(old, new)
+        suffix = get_common_suffix_length(old, new, min(len(old), len(new)) - prefix)
+        old_end = len(old) - suffix
+        new_end = len(new) - suffix
+        return (cls(((prefix, old_end, new[prefix:new_end]),)),
+                cls(((prefix, new_end, old[prefix:old_end]),)))
+
+    @classmethod
+    def from_lines(cls, old: str, new: str) -> tuple["LinePatch", "LinePatch"]:
+        """Return patches turning ``old`` into ``new`` and back. Only the
+        content-defined chunks that differ are stored.
+        """
+        from textension.fast_seqmatch import split_chunks, unified_diff
+
+        a = split_chunks(old)
+        b = split_chunks(new)
+        a_offsets = [0, *accumulate(map(len, a))]
+        b_offsets = [0, *accumulate(map(len, b))]
+
+        forward = []
+        reverse = []
+        for op, start, end, new_start, new_end in reversed(unified_diff(a, b)):
+            if op != "equal":
+                forward += (a_offsets[start], a_offsets[end], "".join(b[new_start:new_end])),
+                reverse += (b_offsets[new_start], b_offsets[new_end], "".join(a[start:end])),
+        return cls(forward), cls(reverse)
+
+
+# Slice comparisons run in C, so a binary search beats a character loop.
+def get_common_prefix_length(a: str, b: str) -> int:
+    low = 0
+    high = min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) >> 1
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def get_common_suffix_length(a: str, b: str, limit: int) -> int:
+    low = 0
+    high = limit
+    while low < high:
+        mid = (low + high + 1) >> 1
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+class LineRef(tuple):
+    """A (start, end) range of lines in the state before a step is applied.
+    Step data stores these for blocks moved within a text, instead of their
+    content.
+    """
+    __slots__ = ()
+
+
+def _intern_content(content):
+    if content.__class__ in {LinePatch, LineRef}:
+        return content
+    return list(map_intern(content))
+
+
+# Replace the content of blocks that were deleted in one place and inserted
+# in another with references to where the lines are found before the step.
+def _encode_moves(data: list, min_lines: int) -> None:
+    deleted = {}
+    for index, ((start, end, new), (new_start, new_end, old)) in enumerate(data):
+        if not new and new_start == new_end and len(old) >= min_lines:
+            deleted.setdefault(tuple(old), []).append(index)
+
+    if not deleted:
+        return
+
+    for index, ((start, end, new), (new_start, new_end, old)) in enumerate(data):
+        if start == end and not old and (indices := deleted.get(tuple(new))):
+            (d_start, d_end, _), (d_new_start, d_new_end, _) = data[source := indices.pop()]
+            data[index] = (start, end, LineRef((d_start, d_end))), (new_start, new_end, ())
+            data[source] = (d_start, d_end, ()), (d_new_start, d_new_end, LineRef((new_start, new_end)))
+
+
+# Intern the lines of deserialized step data, so that they're shared with
+# other steps.
+def _intern_data(data: list) -> list:
+    return [((start, end, _intern_content(new)), (new_start, new_end, _intern_content(old)))
+            for (start, end, new), (new_start, new_end, old) in data]
+
+
+def _content_to_record(content) -> list:
+    # Content is tagged by type, "L" lines, "P" LinePatch and "R" LineRef.
+    if content.__class__ is LinePatch:
+        return ["P", list(map(list, content))]
+    elif content.__class__ is LineRef:
+        return ["R", *content]
+    return ["L", list(content)]
+
+
+def _check_sequence(obj, size=None) -> list:
+    if obj.__class__ is not list or (size is not None and len(obj) != size):
+        raise ValueError(f"Expected a list of size {size}" if size else "Expected a list")
+    return obj
+
+
+def _check_ints(obj, size=None) -> list:
+    _check_sequence(obj, size)
+    for value in obj:
+        if value.__class__ is not int or value < 0:
+            raise ValueError("Expected a non-negative integer")
+    return obj
+
+
+def _content_from_record(record):
+    kind, *args = _check_sequence(record)
+    if kind == "L" and len(args) == 1:
+        lines = _check_sequence(args[0])
+        if all(line.__class__ is str for line in lines):
+            return list(map_intern(lines))
+
+    elif kind == "P" and len(args) == 1:
+        edits = []
+        for edit in _check_sequence(args[0]):
+            start, end, string = _check_sequence(edit, 3)
+            _check_ints([start, end], 2)
+            if string.__class__ is not str:
+                break
+            edits += (start, end, string),
+        else:
+            return LinePatch(edits)
+
+    elif kind == "R":
+        return LineRef(_check_ints(args, 2))
+
+    raise ValueError("Malformed step content")
+
+
+def _range_from_record(record) -> tuple:
+    start, end, content = _check_sequence(record, 3)
+    _check_ints([start, end], 2)
+    return start, end, _content_from_record(content)
+
+
+def get_state_hash(lines: list[str]) -> bytes:
+    """Return a digest of a list of lines for comparing states."""
+    string = "\n".join(lines).encode(errors="surrogatepass")
+    return hashlib.blake2b(string, digest_size=16).digest()
+
+
 # TODO: This should be part of UndoStack.
 class Step:
-    __slots__ = ("data", "cursor", "tag")
+    __slots__ = ("_data", "blob", "cursor", "tag", "size")
 
-    data:    str
+    _data:   list | None
     cursor:  list[tuple[int]]
     tag:     str
+    size:    int
 
-    def merge(self, stack: UndoStack):
-        lines = stack.state
+    # The compressed data of a frozen step, otherwise None.
+    blob:    bytes | None
 
-        for data in self.data:
-            start, end, content = data[1]
-            lines[start:end] = content
+    # Lines longer than this are diffed and stored as chunks.
+    chunk_threshold = 4096
+
+    # Lines longer than this are stored as a single character edit. Shorter
+    # lines are cheaper to store whole.
+    delta_threshold = 64
 
-        self.__init__(stack, tag=self.tag)
+    # Blocks of at least this many lines are stored as moves when deleted in
+    # one place and inserted in another.
+    move_threshold = 2
 
-    def generate(self, lines: list[str], new_lines: list[str]):
+    @property
+    def data(self) -> list:
+        # Frozen steps are inflated on access, but stay frozen.
+        if self.blob is not None:
+            return _intern_data(pickle.loads(zlib.decompress(self.blob)))
+        return self._data
+
+    @data.setter
+    def data(self, data: list):
+        self._data = data
+        self.blob = None
+
+    def freeze(self) -> int:
+        """Compress the step's data. Returns the change in size."""
+        if self.blob is None and self._data:
+            self.blob = zlib.compress(pickle.dumps(self._data, pickle.HIGHEST_PROTOCOL), 1)
+            self._data = None
+            return self._update_size()
+        return 0
+
+    def thaw(self) -> int:
+        """Inflate the step's data. Returns the change in size."""
+        if self.blob is not None:
+            self.data = self.data
+            return self._update_size()
+        return 0
+
+    def _update_size(self) -> int:
+        size = self.size
+        self.size = self.get_size()
+        return self.size - size
+
+    def merge(self, stack: UndoStack, hint=None):
+        lines = stack.state
+
+        if hint is not None:
+            # Widen the hint to include the lines this step changed, then
+            # map its end back to the state before this step.
+            start, end = hint
+            delta = 0
+            for (old_start, old_end, _), (new_start, new_end, _) in self.data:
+                start = min(start, new_start)
+                end = max(end, new_end)
+                delta += (new_end - new_start) - (old_end - old_start)
+            hint = start, end - delta
+
+        self.apply(lines, True)
+        self.__init__(stack, tag=self.tag, hint=hint)
+
+    def apply(self, state: LineRope, is_reverse: bool) -> list[tuple]:
+        """Apply the step's data to ``state``, in reverse if ``is_reverse``.
+        Returns the changes as (start, end, lines) replacements.
+        """
+        # Moved lines are referenced by their position before the step.
+        base = state.copy()
+        changes = []
+
+        for data in self.data:
+            start, end, content = data[is_reverse]
+            if content.__class__ is LinePatch:
+                content = [content.apply(state[start])]
+            elif content.__class__ is LineRef:
+                content = base[content[0]:content[1]]
+            state[start:end] = content
+            changes += (start, end, content),
+        return changes
+
+    def generate(self, lines: list[str], new_lines: list[str], offset=0):
         from textension.fast_seqmatch import unified_diff
 
         data = []
@@ -986,25 +1556,106 @@ class Step:
             if op == "equal":
                 continue
 
+            # Only the stored lines are interned, so that steps share them.
             old = new = ()
             if op != "delete":
-                new = new_lines[new_start:new_end]
+                new = list(map_intern(new_lines[new_start:new_end]))
 
             if op != "insert":
-                old = lines[start:end]
+                old = list(map_intern(lines[start:end]))
 
             lines[start:end] = new
+
+            # Store only the changed part of a single modified line.
+            if op == "replace" and end - start == new_end - new_start == 1:
+                length = max(len(old[0]), len(new[0]))
+                if length > self.chunk_threshold:
+                    new, old = LinePatch.from_lines(old[0], new[0])
+                elif length > self.delta_threshold:
+                    new, old = LinePatch.from_affixes(old[0], new[0])
+
+            start += offset
+            end += offset
+            new_start += offset
+            new_end += offset
             data += ((start, end, new), (new_start, new_end, old)),
+
+        _encode_moves(data, self.move_threshold)
         return data
 
-    def __init__(self, stack: UndoStack, tag=""):
-        # "foo\n".splitlines()  ->  ["foo"]
-        # "foo\n".split("\n")   ->  ["foo", ""]  (what we want)
-        new_lines = stack.adapter.get_string().split("\n")
+    def generate_from_hint(self, stack: UndoStack, hint: tuple[int, int], string: str):
+        """Generate data only for the lines within ``hint``. Returns None if
+        the state with the hinted lines replaced doesn't match ``string``,
+        the adapter's current text.
+        """
+        lines = stack.state
+        adapter = stack.adapter
+        start, end = hint
+
+        new_end = end + adapter.get_line_count() - len(lines)
+        if not 0 <= start <= end <= len(lines) or new_end < start:
+            return None
+
+        old_lines = lines[start:end]
+        new_lines = list(adapter.get_lines(start, new_end))
+        lines[start:end] = new_lines
 
+        # The text may have changed outside the hint without a push, e.g. by
+        # a script or an operator that isn't overridden. Comparing the whole
+        # text runs in C and is far cheaper than diffing it.
+        if string != lines.join("\n"):
+            lines[start:new_end] = old_lines
+            return None
+        return self.generate(old_lines, new_lines, offset=start)
+
+    def __init__(self, stack: UndoStack, tag="", hint=None):
         self.tag = tag
-        self.data = self.generate(stack.state, new_lines)
+        string = stack.adapter.get_string()
+
+        if hint is None or (data := self.generate_from_hint(stack, hint, string)) is None:
+            # "foo\n".splitlines()  ->  ["foo"]
+            # "foo\n".split("\n")   ->  ["foo", ""]  (what we want)
+            new_lines = string.split("\n")
+            data = self.generate(list(stack.state), new_lines)
+            stack.state = LineRope(new_lines)
+
+        self.data = data
         self.cursor = list((stack.adapter.get_cursor(),) * 2)
+        self.size = self.get_size()
+
+    def to_record(self) -> list:
+        """Return the step as JSON-compatible data. See ``from_record``."""
+        data = [[[start, end, _content_to_record(new)], [new_start, new_end, _content_to_record(old)]]
+                for (start, end, new), (new_start, new_end, old) in self.data]
+        return [self.tag, list(map(list, self.cursor)), data]
+
+    @classmethod
+    def from_record(cls, record: list) -> "Step":
+        """Create a step from data returned by ``to_record``. The record may
+        come from an untrusted file, so its structure is validated. Raises
+        ValueError if it's malformed.
+        """
+        tag, cursor, data = _check_sequence(record, 3)
+        if tag.__class__ is not str:
+            raise ValueError("Expected a string tag")
+
+        self = cls.__new__(cls)
+        self.tag = tag
+        self.cursor = [tuple(_check_ints(c)) for c in _check_sequence(cursor, 2)]
+        self.data = [(_range_from_record(new), _range_from_record(old))
+                     for new, old in map(_check_sequence, _check_sequence(data), repeat(2))]
+        self.size = self.get_size()
+        return self
+
+    def get_size(self) -> int:
+        """Return the approximate size in bytes of the step's data."""
+        if self.blob is not None:
+            return getsizeof(self.blob)
+
+        size = 0
+        for (_, _, new), (_, _, old) in self.data:
+            size += get_content_size(new) + get_content_size(old)
+        return size
 
     def __repr__(self):
         return f"<Step tag={self.tag} at 0x{id(self):0>16X}>"